@@ -1,86 +1,86 @@
-from itertools import groupby
 import attr
+import re
 import typing
 
+from instrumentor.registry import make_index_key, make_metric_key
 
-@attr.s
-class RedisKeyValuePair:
-    key = attr.ib()
-    value = attr.ib()
 
+# Matches the le label of a bucket row and the comma separating it from the other
+# labels.
+BUCKET_LABEL_PATTERN = re.compile(rb',?le="([^"]*)"')
 
-@attr.s
-class MetricValue:
-    type = attr.ib()
-    labels = attr.ib()
-    value = attr.ib()
 
+def row_sort_key(row: typing.Tuple[bytes, bytes, bytes]) -> tuple:
+    """
+    Sort key for the rows of a metric. Rows are grouped by value type and labels.
+    Buckets of the same labels are ordered by their numeric upper bound, so +Inf
+    comes last as the exposition format requires.
+    :param row: (type, labels, value) tuple
+    :return: tuple
+    """
+    value_type, labels, _ = row
+    if value_type != b"bucket":
+        return value_type, labels, 0.0
+
+    match = BUCKET_LABEL_PATTERN.search(labels)
+    if match is None:
+        return value_type, labels, 0.0
+
+    other_labels = labels[: match.start()] + labels[match.end() :]
+    return value_type, other_labels.lstrip(b","), float(match.group(1))
 
-@attr.s
+
+@attr.s(slots=True)
 class MetricSet:
+    """
+    Values are kept as (type, labels, value) tuples to keep the per row overhead low.
+    Everything except the name is kept as the raw bytes returned from Redis.
+    """
+
+    TYPE_MAP = {
+        b"c": b"counter",
+        b"g": b"gauge",
+        b"h": b"histogram",
+        b"s": b"summary",
+    }
+    VALUE_TYPE_MAP = {b"b": b"bucket", b"c": b"count", b"s": b"sum"}
 
     name: str = attr.ib()
-    description: str = attr.ib(default=None)
-    type: str = attr.ib(default=None)
-    values: typing.List[MetricValue] = attr.ib(default=attr.Factory(list))
-
-    def add_item(self, kv_pair: RedisKeyValuePair):
-        extension, labels = self._split_key(kv_pair.key)
-
-        if labels is None:
-            labels = ""
-
-        if extension == "d":
-            self.description = kv_pair.value
-
-        elif extension == "t":
-
-            if kv_pair.value == "c":
-                self.type = "counter"
-            elif kv_pair.value == "g":
-                self.type = "gauge"
-            elif kv_pair.value == "h":
-                self.type = "histogram"
-            elif kv_pair.value == "s":
-                self.type = "summary"
-        elif extension == "b":
-            self.values.append(
-                MetricValue(type="bucket", labels=labels, value=kv_pair.value)
-            )
+    description: bytes = attr.ib(default=b"")
+    type: bytes = attr.ib(default=b"untyped")
+    values: typing.List[typing.Tuple[bytes, bytes, bytes]] = attr.ib(
+        default=attr.Factory(list)
+    )
 
-        elif extension == "c":
-            self.values.append(
-                MetricValue(type="count", labels=labels, value=kv_pair.value)
-            )
+    def add_item(self, key: bytes, value: bytes):
+        _, extension, labels = key.split(b":", 2)
 
-        elif extension == "s":
-            self.values.append(
-                MetricValue(type="sum", labels=labels, value=kv_pair.value)
-            )
+        if extension == b"d":
+            self.description = value
 
-        else:
-            self.values.append(
-                MetricValue(type=None, labels=labels, value=kv_pair.value)
-            )
+        elif extension == b"t":
+            self.type = self.TYPE_MAP.get(value, self.type)
 
-    @staticmethod
-    def _split_key(key):
-        parts = key.split(":")
-        name = parts[0]
-        ext = parts[1]
-        labels = parts[2]
-        return ext, labels
+        else:
+            self.values.append((self.VALUE_TYPE_MAP.get(extension, b""), labels, value))
 
 
 class ExpositionClient:
     """
     Very simple implementation of client that will get all available metrics from a
     namespace and expose a string formatted accoring to Prometheus expositions format.
+
+    :param redis_client: Redis client
+    :param namespace: Namespace of the metrics to expose
+    :param scan_count: COUNT hint used when scanning metric hashes. Bounds the work
+        Redis does per call when a metric has many label combinations.
     """
 
-    def __init__(self, redis_client, namespace: str):
+    def __init__(self, redis_client, namespace: str, scan_count: int = 500):
         self.redis = redis_client
         self.namespace = namespace
+        self.scan_count = scan_count
+        self._headers = dict()
 
     def _get_data(self) -> typing.List[MetricSet]:
         """
@@ -88,50 +88,100 @@ class ExpositionClient:
         :return:
         """
 
-        results = self.redis.hgetall(self.namespace)
-
-        sorted_results = sorted(
-            [
-                RedisKeyValuePair(key.decode(), val.decode())
-                for key, val in results.items()
-            ]
+        metric_names = sorted(
+            name.decode()
+            for name in self.redis.smembers(make_index_key(self.namespace))
         )
 
+        metric_keys = [
+            make_metric_key(self.namespace, metric_name) for metric_name in metric_names
+        ]
+
+        # Small hashes are returned in full by the first HSCAN call so most metrics
+        # are read in a single pipelined round trip. Only large hashes need more
+        # calls to finish the scan.
+        pipe = self.redis.pipeline(transaction=False)
+        for metric_key in metric_keys:
+            pipe.hscan(metric_key, count=self.scan_count)
+        results = pipe.execute()
+
         metrics = list()
 
-        for metric_name, metric_items in groupby(
-            sorted_results, key=lambda x: x.key.split(":")[0]
+        for metric_name, metric_key, (cursor, metric_items) in zip(
+            metric_names, metric_keys, results
         ):
+            while cursor:
+                cursor, more_items = self.redis.hscan(
+                    metric_key, cursor=cursor, count=self.scan_count
+                )
+                # HSCAN can return a field more than once.
+                metric_items.update(more_items)
+
+            if not metric_items:
+                continue
+
             metric = MetricSet(name=metric_name)
-            for item in list(metric_items):
-                metric.add_item(item)
+            for key, val in metric_items.items():
+                metric.add_item(key, val)
 
+            # Hash order depends on Redis internals. Sorting the rows of one metric
+            # is cheap and keeps the output stable between scrapes.
+            metric.values.sort(key=row_sort_key)
             metrics.append(metric)
         return metrics
 
+    def _get_header(self, metric: MetricSet) -> typing.Tuple[bytes, bytes]:
+        """
+        The HELP and TYPE lines only depend on the metric definition so they are
+        built once and reused between scrapes.
+        :return: Tuple of encoded metric name and header lines
+        """
+        cache_key = (metric.name, metric.description, metric.type)
+        cached = self._headers.get(cache_key)
+        if cached is None:
+            name = metric.name.encode()
+            header = b"".join(
+                (
+                    b"# HELP ",
+                    name,
+                    b" ",
+                    metric.description,
+                    b"\n# TYPE ",
+                    name,
+                    b" ",
+                    metric.type,
+                    b"\n",
+                )
+            )
+            cached = (name, header)
+            self._headers[cache_key] = cached
+        return cached
+
     def expose(self):
         """
         Returns Prometheus formatted data.
         :return:
         """
         metrics = self._get_data()
-        out = ""
+        parts = []
+        extend = parts.extend
         for metric in metrics:
-            out += f"# HELP {metric.name} {metric.description}\n"
-            out += f"# TYPE {metric.name} {metric.type}\n"
-            for value in metric.values:
-
-                if value.type and value.labels:
-                    out += (
-                        f"{metric.name}_{value.type}{{{value.labels}}} {value.value}\n"
+            name, header = self._get_header(metric)
+            parts.append(header)
+            for value_type, labels, value in metric.values:
+                extend(
+                    (
+                        name,
+                        b"_" if value_type else b"",
+                        value_type,
+                        b"{" if labels else b"",
+                        labels,
+                        b"} " if labels else b" ",
+                        value,
+                        b"\n",
                     )
-                elif value.type and not value.labels:
-                    out += f"{metric.name}_{value.type} {value.value}\n"
-                elif not value.type and value.labels:
-                    out += f"{metric.name}{{{value.labels}}} {value.value}\n"
-                else:
-                    out += f"{metric.name} {value.value}\n"
+                )
 
-            out += f"\n"
+            parts.append(b"\n")
 
-        return out
+        return b"".join(parts).decode()
@@ -1,10 +1,10 @@
+import bisect
 import functools
-import contextlib
-from typing import Dict, List
+import inspect
+from collections import defaultdict
+from typing import Any, Dict, List, NamedTuple
 import time
 
-import attr
-
 
 NO_LABELS_KEY = "__"
 HISTOGRAM_LABEL = "le"
@@ -12,21 +12,51 @@ SUMMARY_LABEL = "quantile"
 INFINITY_FOR_HISTOGRAM = "+Inf"
 TYPE_EXTENSION_LETTER = "t"
 DESCRIPTION_EXTENSION_LETTER = "d"
+NANOSECONDS_PER_SECOND = 1_000_000_000
+NANOSECONDS_PER_MILLISECOND = 1_000_000
+# Name of the Redis set indexing the metrics of a namespace. Metric hashes share the
+# {namespace}:{metric_name} key format so no metric can have this name.
+INDEX_KEY = "__index__"
+# Upper bound of label combinations kept in the per metric caches.
+MAX_CACHED_LABEL_COMBINATIONS = 4096
+
+
+if hasattr(time, "perf_counter_ns"):
+    _perf_counter_ns = time.perf_counter_ns
+else:
+    # time.perf_counter_ns is only available from Python 3.7.
+    def _perf_counter_ns() -> int:
+        return int(time.perf_counter() * NANOSECONDS_PER_SECOND)
 
 
-@attr.s
-class UpdateAction:
+@functools.lru_cache(maxsize=4096)
+def _format_labels(label_items: tuple) -> str:
     """
-    Simple dataclass to hold update data for Redis.
+    Formats sorted label items as {label_name}="{label_value}" pairs separated by
+    commas. Label combinations are usually drawn from a small set so the result is
+    cached and shared between all metrics.
+
+    :param label_items: Tuple of (label_name, label_value) sorted by label name. Values
+        must already be strings, otherwise values that compare equal but format
+        differently, like 1 and 1.0, would share a cache entry.
+    :return: str
+    """
+    return ",".join('%s="%s"' % label_item for label_item in label_items)
+
+
+class UpdateAction(NamedTuple):
+    """
+    Simple named tuple to hold update data for Redis. One is created for every
+    metric update so it is kept as cheap to create as possible.
 
     :param key: Redis key
     :param value: Redis value
     :param set: Indicates if a SET command should be used to write to Redis.
     """
 
-    key = attr.ib()
-    value = attr.ib()
-    set = attr.ib(default=False)
+    key: str
+    value: Any
+    set: bool = False
 
 
 class Metric:
@@ -43,13 +73,36 @@ class Metric:
     INTERNAL_LABELS = []
     TYPE_KEY = None
 
+    __slots__ = (
+        "name",
+        "description",
+        "allowed_labels",
+        "_allowed_labels_set",
+        "_label_cache",
+        "_redis_key_cache",
+        "registry",
+        "metric_type_key",
+        "metric_description_key",
+    )
+
     def __init__(self, name, description, allowed_labels=None):
 
+        if name == INDEX_KEY:
+            raise ValueError(f"Metric name {name} is reserved")
+
         self.name = name
         self.description = description
         self.allowed_labels = self._clean_allowed_labels(allowed_labels)
+        self._allowed_labels_set = frozenset(self.allowed_labels)
+        self._label_cache = dict()
+        self._redis_key_cache = dict()
         self.registry = None
-        self.registered_remotely = False
+        # Type key is structured as {metric_name}:{type_extension_letter}: and
+        # description key as {metric_name}:{description_extension_letter}:
+        self.metric_type_key = self.make_redis_key(extension=TYPE_EXTENSION_LETTER)
+        self.metric_description_key = self.make_redis_key(
+            extension=DESCRIPTION_EXTENSION_LETTER
+        )
 
     def add_registry(self, registry) -> None:
         """
@@ -69,57 +122,37 @@ class Metric:
 
     def propagate(self, update_actions: List[UpdateAction]) -> None:
         """
-        Will propagate counter updates up to the registry. 
-        
-        Metric type and description will only be propagated to redis once.
+        Will propagate counter updates up to the registry.
+
+        Metric type and description are written by the registry when the updates are
+        transferred to redis.
         :param update_actions: List of update actions
         :return:
         """
 
-        if not self.registry:
+        if self.registry is None:
             raise RuntimeError(
                 f"Counter {self.name} is not yet registered in a CollectorRegistry"
             )
 
-        to_propagate = list()
-
-        for item in update_actions:
-            # TODO: are we missing the :: after value? is that ok?
-            if item.key == NO_LABELS_KEY:
-                to_propagate.append(UpdateAction(key=self.name, value=item.value))
-
-            else:
-                to_propagate.append(item)
-
-        if not self.registered_remotely:
-            to_propagate.append(
-                UpdateAction(key=self.metric_type_key, value=self.TYPE_KEY, set=True)
-            )
-            to_propagate.append(
-                UpdateAction(
-                    key=self.metric_description_key, value=self.description, set=True
-                )
-            )
-            # Only propagate type and description once.
-            self.registered_remotely = True
+        # Update actions always carry full redis keys built by make_redis_key, so
+        # they are handed to the registry as they are.
+        self.registry.update_buffer(update_actions)
 
-        self.registry.update_buffer(to_propagate)
-
-    @property
-    def metric_type_key(self) -> str:
+    def propagate_one(self, update_action: UpdateAction) -> None:
         """
-        Type Key should be structured as {metric_name}:{type_extension_letter}:
-        :return: str
+        Will propagate a single update up to the registry. Metric updates produce one
+        update action each so this saves wrapping every update in a list.
+        :param update_action: Update action
+        :return:
         """
-        return self.make_redis_key(extension=TYPE_EXTENSION_LETTER)
 
-    @property
-    def metric_description_key(self) -> str:
-        """
-        Description key should be structured as {metric_name}:{description_extension_letter}
-        :return: str
-        """
-        return self.make_redis_key(extension=DESCRIPTION_EXTENSION_LETTER)
+        if self.registry is None:
+            raise RuntimeError(
+                f"Counter {self.name} is not yet registered in a CollectorRegistry"
+            )
+
+        self.registry.update_buffer_one(update_action)
 
     def _check_labels(self, labels=None) -> dict:
         """
@@ -137,7 +170,10 @@ class Metric:
                     f"{self.__class__.__name__}"
                 )
 
-            if label not in self.allowed_labels and label not in self.INTERNAL_LABELS:
+            if (
+                label not in self._allowed_labels_set
+                and label not in self.INTERNAL_LABELS
+            ):
                 raise ValueError(
                     f"Label name {label} is not an allowed label in metric {self.name}"
                 )
@@ -174,6 +210,10 @@ class Metric:
         labels are typed.
         Format is {label_name}="{label_value}" which is also the Prometheus format.
         To handle the case with no lables the NO_LABELS_KEY is used.
+        Encoded labels are cached per label combination so checking, sorting and
+        formatting is only done the first time a combination is used. The cache is
+        keyed on the formatted label values since values that compare equal, like 1
+        and 1.0, are formatted differently.
 
         :param labels: Metric labels
         :return: str
@@ -181,14 +221,20 @@ class Metric:
         if not labels:
             return NO_LABELS_KEY
 
-        _labels = self._check_labels(labels)
+        cache_key = frozenset((name, str(value)) for name, value in labels.items())
+        label_string = self._label_cache.get(cache_key)
+        if label_string is not None:
+            return label_string
 
-        label_string = ""
-        for label_name, label_value in sorted(_labels.items()):
+        _labels = self._check_labels(labels)
 
-            label_string += f'{label_name}="{label_value}",'
+        label_string = _format_labels(
+            tuple(sorted((name, str(value)) for name, value in _labels.items()))
+        )
+        if len(self._label_cache) < MAX_CACHED_LABEL_COMBINATIONS:
+            self._label_cache[cache_key] = label_string
 
-        return label_string[:-1]  # removes last comma
+        return label_string
 
     def make_redis_key(self, name="", extension="", labels="") -> str:
         """
@@ -204,6 +250,20 @@ class Metric:
 
         return f"{_name}:{extension}:{labels}"
 
+    def _cached_redis_key(self, encoded_labels: str) -> str:
+        """
+        Returns the redis key for the value of a label combination. The key is only
+        structured the first time the label combination is used.
+        :param encoded_labels: Labels encoded by _encode_labels
+        :return: str
+        """
+        key = self._redis_key_cache.get(encoded_labels)
+        if key is None:
+            key = self.make_redis_key(labels=encoded_labels)
+            if len(self._redis_key_cache) < MAX_CACHED_LABEL_COMBINATIONS:
+                self._redis_key_cache[encoded_labels] = key
+        return key
+
 
 class Counter(Metric):
     """
@@ -212,10 +272,12 @@ class Counter(Metric):
 
     TYPE_KEY = "c"
 
+    __slots__ = ("counts",)
+
     def __init__(self, name, description, allowed_labels=None):
         super().__init__(name, description, allowed_labels)
 
-        self.counts = {NO_LABELS_KEY: 0}
+        self.counts = defaultdict(int, {NO_LABELS_KEY: 0})
 
     def inc(self, value=1, labels: Dict[str, str] = None) -> None:
         """
@@ -233,14 +295,21 @@ class Counter(Metric):
                 f"provided negative value: {value}"
             )
 
-        key = self._encode_labels(labels)
-        current_value = self.counts.get(key, 0)
-        new_value = current_value + value
+        self._inc_encoded(self._encode_labels(labels), value)
 
+    def _inc_encoded(self, key: str, value=1) -> None:
+        """
+        Increases the counter for already encoded labels.
+
+        :param key: Labels encoded by _encode_labels
+        :param value:
+        :return:
+        """
+        new_value = self.counts[key] + value
         self.counts[key] = new_value
 
-        self.propagate(
-            [UpdateAction(key=self.make_redis_key(labels=key), value=new_value)]
+        self.propagate_one(
+            UpdateAction(key=self._cached_redis_key(key), value=new_value)
         )
 
     def reset(self):
@@ -248,7 +317,8 @@ class Counter(Metric):
         Clears all the counters and sets counter dict to initial state.
         :return:
         """
-        self.counts = {NO_LABELS_KEY: 0}
+        self.counts.clear()
+        self.counts[NO_LABELS_KEY] = 0
 
     def count(self, _func=None, *, labels=None):
         """
@@ -257,14 +327,7 @@ class Counter(Metric):
         :return:
         """
 
-        def count_decorator(func):
-            @functools.wraps(func)
-            def count_wrapper(*args, **kwargs):
-                result = func(*args, **kwargs)
-                self.inc(labels=labels)
-                return result
-
-            return count_wrapper
+        count_decorator = _make_count_decorator(self, labels)
 
         if _func is None:
             return count_decorator
@@ -279,10 +342,12 @@ class Gauge(Metric):
 
     TYPE_KEY = "g"
 
+    __slots__ = ("counts", "set_command_issued")
+
     def __init__(self, name, description, allowed_labels=None, initial_value=0):
         super().__init__(name, description, allowed_labels)
 
-        self.counts = {NO_LABELS_KEY: initial_value}
+        self.counts = defaultdict(int, {NO_LABELS_KEY: initial_value})
         self.set_command_issued = set()
 
     def inc(self, value=1, labels: Dict[str, str] = None) -> None:
@@ -304,18 +369,29 @@ class Gauge(Metric):
                 f"inc() only accepts positive values. If you want to decreace use dec()."
             )
 
-        key = self._encode_labels(labels)
-        current_value = self.counts.get(key, 0)
-        new_value = current_value + value
+        self._inc_encoded(self._encode_labels(labels), value)
 
-        if self._check_set_command_issued(key):
-            self.set(new_value, labels)
+    def _inc_encoded(self, key: str, value=1) -> None:
+        """
+        Increases the value for already encoded labels. Used by both inc and dec, dec
+        passes a negative value.
+
+        :param key: Labels encoded by _encode_labels
+        :param value: Value to increase by
+        :return:
+        """
+        new_value = self.counts[key] + value
+
+        # Once a set command has been issued for the label combination the local and
+        # remote state are the same, so later changes are also issued as sets.
+        if key in self.set_command_issued:
+            self._set_encoded(key, new_value)
 
         else:
             # uses incrby and we dont need to know the current value.
             self.counts[key] = new_value
-            self.propagate(
-                [UpdateAction(key=self.make_redis_key(labels=key), value=new_value)]
+            self.propagate_one(
+                UpdateAction(key=self._cached_redis_key(key), value=new_value)
             )
 
     def dec(self, value=1, labels: Dict[str, str] = None) -> None:
@@ -336,18 +412,7 @@ class Gauge(Metric):
                 f"dec() only accepts positive values. If you want to increase use inc()."
             )
 
-        key = self._encode_labels(labels)
-        current_value = self.counts.get(key, 0)
-        new_value = current_value - value
-
-        if self._check_set_command_issued(key):
-            self.set(new_value, labels)
-
-        else:
-            self.counts[key] = new_value
-            self.propagate(
-                [UpdateAction(key=self.make_redis_key(labels=key), value=new_value)]
-            )
+        self._inc_encoded(self._encode_labels(labels), -value)
 
     def set(self, value, labels: Dict[str, str] = None) -> None:
         """
@@ -358,12 +423,20 @@ class Gauge(Metric):
         :return:
         """
 
-        key = self._encode_labels(labels)
+        self._set_encoded(self._encode_labels(labels), value)
+
+    def _set_encoded(self, key: str, value) -> None:
+        """
+        Sets the value for already encoded labels.
 
+        :param key: Labels encoded by _encode_labels
+        :param value: Value to set
+        :return:
+        """
         self.counts[key] = value
 
-        self.propagate(
-            [UpdateAction(key=self.make_redis_key(labels=key), value=value, set=True)]
+        self.propagate_one(
+            UpdateAction(key=self._cached_redis_key(key), value=value, set=True)
         )
 
         self.set_command_issued.add(key)
@@ -375,18 +448,6 @@ class Gauge(Metric):
         """
         pass
 
-    def _check_set_command_issued(self, label_combination):
-        """
-        To keep track of when to use a set command or an incr commands we are tracking
-        the issued set commands. Returns True if a set command been issued for the
-        label combination
-
-        :param label_combination:
-        :return:
-        """
-
-        return label_combination in self.set_command_issued
-
 
 class Histogram(Metric):
 
@@ -411,12 +472,30 @@ class Histogram(Metric):
     INTERNAL_LABELS = [HISTOGRAM_LABEL]
     TYPE_KEY = "h"
 
+    __slots__ = (
+        "buckets",
+        "_sorted_buckets",
+        "_bucket_keys_cache",
+        "counts",
+        "sum",
+        "sums",
+        "total_count",
+        "set_command_issued",
+    )
+
     def __init__(self, name, description, buckets=None, allowed_labels=None):
         super().__init__(name, description, allowed_labels)
 
         self.buckets = buckets
+        # Buckets are kept sorted so an observation only has to visit the buckets
+        # that are equal or higher than the observed value.
+        self._sorted_buckets = sorted(buckets) if buckets else list()
+        # Encoded bucket labels for each sorted bucket, per user label combination.
+        self._bucket_keys_cache = dict()
         self.counts = dict()
         self.sum = 0
+        # Sum of the observed values per label combination.
+        self.sums = dict()
         self.total_count = 0
         self.set_command_issued = set()
 
@@ -429,78 +508,113 @@ class Histogram(Metric):
         :return:
         """
 
-        for bucket in self.buckets:
-            if bucket >= value:
-                self._add_observed_value(bucket, labels)
+        self._observe_encoded(self._encode_labels(labels), value, labels)
 
-        # TODO: should the sum and count be sensitive to labels?
-        self._add_to_histogram_sum(value)
-        self._increase_total_count()
-
-    def _add_observed_value(self, bucket, labels=None):
+    def _observe_encoded(self, labels_key, value, labels=None):
         """
-        Adds increases the count for a given label combination but also adds the
-        bucket label to the label combination
-        :param bucket: bucket to increase
-        :param labels: metric labels
+        Adds an observation for already encoded labels.
+        :param labels_key: metric labels encoded by _encode_labels
+        :param value:
+        :param labels: metric labels, only used the first time the label combination
+            is observed to encode the bucket labels
         :return:
         """
-        bucket_label = {"le": bucket}
-        if not labels:
-            metric_labels = dict()
+        if value != value:
+            # NaN is not lower or equal to any bucket, it is only counted in +Inf.
+            start = len(self._sorted_buckets)
         else:
-            metric_labels = labels
-        all_labels = {**bucket_label, **metric_labels}
-        count_key = self._encode_labels(all_labels)
+            start = bisect.bisect_left(self._sorted_buckets, value)
+        # The last bucket is always +Inf, so every observation increases it.
+        update_actions = [
+            self._increase_bucket(count_key)
+            for count_key in self._bucket_keys(labels_key, labels)[start:]
+        ]
+        infinity_count = update_actions[-1].value
+
+        update_actions.append(self._add_to_histogram_sum(labels_key, value))
+        update_actions.append(self._increase_total_count(labels_key, infinity_count))
+
+        # All updates of an observation are propagated together.
+        self.propagate(update_actions)
+
+    def _bucket_keys(self, labels_key, labels=None) -> list:
+        """
+        Returns the encoded labels of every bucket, in sorted bucket order and
+        followed by the +Inf bucket, for a label combination. They are encoded the
+        first time a label combination is observed so observing does not have to merge
+        and encode labels per bucket.
+
+        :param labels_key: metric labels encoded by _encode_labels
+        :param labels: metric labels
+        :return: list
+        """
+        bucket_keys = self._bucket_keys_cache.get(labels_key)
+        if bucket_keys is not None:
+            return bucket_keys
+
+        metric_labels = labels or dict()
+        bucket_keys = [
+            self._encode_labels({"le": bucket, **metric_labels})
+            for bucket in [*self._sorted_buckets, INFINITY_FOR_HISTOGRAM]
+        ]
+        if len(self._bucket_keys_cache) < MAX_CACHED_LABEL_COMBINATIONS:
+            self._bucket_keys_cache[labels_key] = bucket_keys
+
+        return bucket_keys
+
+    def _increase_bucket(self, count_key):
+        """
+        Increases the count of a bucket.
+        :param count_key: encoded labels of the bucket, including the bucket label
+        :return: UpdateAction for the bucket
+        """
         current_value = self.counts.get(count_key, 0)
         new_value = current_value + 1
         self.counts[count_key] = new_value
 
-        self.propagate(
-            [
-                UpdateAction(
-                    key=self.make_redis_key(labels=count_key, extension="b"),
-                    value=new_value,
-                )
-            ]
+        return UpdateAction(
+            key=self.make_redis_key(labels=count_key, extension="b"), value=new_value
         )
 
-    def _add_to_histogram_sum(self, value):
+    def _add_to_histogram_sum(self, labels_key, value):
         """
-        Histogram has a sum that will have the sum of all observed values. When it is
-        changed we also must issue a new update to the remote store.
+        Histogram has a sum that will have the sum of all observed values for each
+        label combination. When it is changed we also must issue a new update to the
+        remote store. The sum attribute keeps the sum over all label combinations.
 
+        :param labels_key: metric labels encoded by _encode_labels
         :param value:
-        :return:
+        :return: UpdateAction for the sum
         """
         self.sum += value
+        new_sum = self.sums.get(labels_key, 0) + value
+        self.sums[labels_key] = new_sum
 
-        self.propagate(
-            [UpdateAction(key=self.make_redis_key(extension="s"), value=self.sum)]
+        return UpdateAction(
+            key=self.make_redis_key(labels=labels_key, extension="s"), value=new_sum
         )
 
-    def _increase_total_count(self):
+    def _increase_total_count(self, labels_key, infinity_count):
         """
-        Histogram should keep a counter for the total number of observations. This
-        counter should have the same value as the bucket counter for +Inf. And for
-        every change we should propagate an update to the remote store.
-        :return:
+        Histogram should keep a counter for the total number of observations for each
+        label combination. This counter should have the same value as the bucket
+        counter for +Inf of the same label combination. And for every change we should
+        propagate an update to the remote store.
+        :param labels_key: metric labels encoded by _encode_labels
+        :param infinity_count: count of the +Inf bucket of the label combination
+        :return: UpdateAction for the count
         """
-        self._add_observed_value(bucket=INFINITY_FOR_HISTOGRAM)
         self.total_count += 1
-        self.propagate(
-            [
-                UpdateAction(
-                    key=self.make_redis_key(extension="c"),
-                    value=self.counts.get('le="+Inf"'),
-                )
-            ]
+        return UpdateAction(
+            key=self.make_redis_key(labels=labels_key, extension="c"),
+            value=infinity_count,
         )
 
     def reset(self):
         """Resets the counters on the Histogram."""
-        self.counts = dict()
+        self.counts.clear()
         self.sum = 0
+        self.sums.clear()
 
     def time(self, _func=None, *, labels=None, milliseconds=False):
         """
@@ -509,19 +623,24 @@ class Histogram(Metric):
         :return:
         """
 
+        # Everything that does not change between calls is looked up once when
+        # decorating so the wrapper only reads the clock and observes.
+        labels_key = self._encode_labels(labels)
+        observe_encoded = self._observe_encoded
+        perf_counter_ns = _perf_counter_ns
+        if milliseconds:
+            ns_per_unit = NANOSECONDS_PER_MILLISECOND
+        else:
+            ns_per_unit = NANOSECONDS_PER_SECOND
+
         def time_decorator(func):
             @functools.wraps(func)
             def time_wrapper(*args, **kwargs):
-                start = time.time()
+                start = perf_counter_ns()
                 result = func(*args, **kwargs)
-                duration = time.time() - start
+                duration_ns = perf_counter_ns() - start
 
-                if milliseconds:
-                    observed = duration * 1000
-                else:
-                    observed = duration
-
-                self.observe(value=observed, labels=labels)
+                observe_encoded(labels_key, duration_ns / ns_per_unit, labels)
                 return result
 
             return time_wrapper
@@ -532,31 +651,71 @@ class Histogram(Metric):
             return time_decorator(_func)
 
 
-def count(*, metric, labels=None):
+def _takes_no_arguments(func) -> bool:
     """
-        Decoration that will count the number of times the decorator has been used,
-        ie. how many times the function is called.
-        :return:
-        """
+    Checks if func is a plain function that is called without arguments.
+    :param func: Function to check
+    :return: bool
+    """
+    code = getattr(func, "__code__", None)
+    if code is None:
+        return False
+    return (
+        code.co_argcount == 0
+        and code.co_kwonlyargcount == 0
+        and not code.co_flags & (inspect.CO_VARARGS | inspect.CO_VARKEYWORDS)
+    )
 
-    if isinstance(metric, (Counter, Gauge)):
 
-        def count_decorator(func):
+def _make_count_decorator(metric, labels=None):
+    """
+    Makes the decorator used by Counter.count and count. Labels are
+    encoded once when decorating instead of on every call and functions that take
+    no arguments get a wrapper that does not pack and unpack arguments.
+    :param metric: Counter or Gauge
+    :param labels: Metric labels
+    :return:
+    """
+    key = metric._encode_labels(labels)
+    inc_encoded = metric._inc_encoded
+
+    def count_decorator(func):
+        if _takes_no_arguments(func):
+
+            @functools.wraps(func)
+            def count_wrapper():
+                result = func()
+                inc_encoded(key)
+                return result
+
+        else:
+
             @functools.wraps(func)
             def count_wrapper(*args, **kwargs):
                 result = func(*args, **kwargs)
-                metric.inc(labels=labels)
+                inc_encoded(key)
                 return result
 
-            return count_wrapper
+        return count_wrapper
+
+    return count_decorator
 
-        return count_decorator
+
+def count(*, metric, labels=None):
+    """
+        Decoration that will count the number of times the decorator has been used,
+        ie. how many times the function is called.
+        :return:
+        """
+
+    if isinstance(metric, (Counter, Gauge)):
+        return _make_count_decorator(metric, labels)
 
     else:
         raise ValueError("Count decorator can only be used with Counters or Gauges.")
 
 
-class timer(contextlib.ContextDecorator):
+class timer:
     """
     A decorator that also can be used as a context manager for timing some execution
 
@@ -572,14 +731,42 @@ class timer(contextlib.ContextDecorator):
         self.milliseconds = milliseconds
         self.start_time = None
 
+    def __call__(self, func):
+        """
+        Wraps func so every call is timed. The start time is kept in the wrapper
+        instead of on the timer so a decorated function can be called recursively
+        or from several threads.
+        :param func: Function to time
+        :return:
+        """
+
+        perf_counter_ns = _perf_counter_ns
+
+        @functools.wraps(func)
+        def timer_wrapper(*args, **kwargs):
+            start = perf_counter_ns()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._observe(perf_counter_ns() - start)
+
+        return timer_wrapper
+
     def __enter__(self):
-        self.start_time = time.time()
+        self.start_time = _perf_counter_ns()
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        duration = time.time() - self.start_time
+        self._observe(_perf_counter_ns() - self.start_time)
+
+    def _observe(self, duration_ns):
+        """
+        Adds a duration to the metric, in seconds or milliseconds.
+        :param duration_ns: Duration in nanoseconds
+        :return:
+        """
         if self.milliseconds:
-            observed = duration * 1000
+            observed = duration_ns / NANOSECONDS_PER_MILLISECOND
         else:
-            observed = duration
+            observed = duration_ns / NANOSECONDS_PER_SECOND
 
         self.metric.observe(value=observed, labels=self.labels)
@@ -1,20 +1,85 @@
-from instrumentor.metrics import Metric, UpdateAction
-from typing import List
+from instrumentor.metrics import INDEX_KEY, Metric, UpdateAction
+from typing import List, Optional
 from itertools import groupby
 from contextlib import contextmanager
+from redis.exceptions import NoScriptError
+
+
+# Applies all buffered updates for one metric in a single call.
+# KEYS[1]: metric hash, KEYS[2]: namespace index set
+# ARGV[1]: metric name, ARGV[2]: type key, ARGV[3]: type,
+# ARGV[4]: description key, ARGV[5]: description
+# followed by (command, key, value) triples where command is "i" for HINCRBY,
+# "f" for HINCRBYFLOAT and "s" for HSET.
+# Type and description are each only written when their field is missing, which
+# is safe even when several processes transfer the same metric concurrently. The
+# metric is always added to the index so it is re-indexed if the index is lost.
+TRANSFER_SCRIPT = """
+redis.call('HSETNX', KEYS[1], ARGV[2], ARGV[3])
+redis.call('HSETNX', KEYS[1], ARGV[4], ARGV[5])
+redis.call('SADD', KEYS[2], ARGV[1])
+for i = 6, #ARGV, 3 do
+    if ARGV[i] == 'i' then
+        redis.call('HINCRBY', KEYS[1], ARGV[i + 1], ARGV[i + 2])
+    elseif ARGV[i] == 'f' then
+        redis.call('HINCRBYFLOAT', KEYS[1], ARGV[i + 1], ARGV[i + 2])
+    else
+        redis.call('HSET', KEYS[1], ARGV[i + 1], ARGV[i + 2])
+    end
+end
+"""
+
+
+def make_metric_key(namespace: str, metric_name: str) -> str:
+    """
+    Each metric is stored in its own Redis hash, structured as
+    {namespace}:{metric_name}
+    :param namespace: Application namespace
+    :param metric_name: Metric name
+    :return: str
+    """
+    return f"{namespace}:{metric_name}"
+
+
+def make_index_key(namespace: str) -> str:
+    """
+    The names of all metrics in a namespace is kept in a Redis set, structured as
+    {namespace}:__index__
+    :param namespace: Application namespace
+    :return: str
+    """
+    return f"{namespace}:{INDEX_KEY}"
 
 
 class CollectorRegistry:
     """
     The CollectorRegistry manages metrics and syncs updates to remote Redis store.
+
+    :param redis_client: Redis client
+    :param namespace: Application namespace
+    :param eager: Transfer every update to Redis directly.
+    :param max_buffer_size: Transfer the buffer to Redis as soon as it holds this many
+        updates. Gives a middle ground between eager and only transferring manually.
     """
 
-    def __init__(self, redis_client, namespace: str, eager: bool = False):
+    def __init__(
+        self,
+        redis_client,
+        namespace: str,
+        eager: bool = False,
+        max_buffer_size: Optional[int] = None,
+    ):
         self.redis = redis_client
         self.namespace = namespace
         self.eager = eager
+        self.max_buffer_size = max_buffer_size
         self.metrics = dict()
         self.buffer = dict()
+        # Loaded on the first transfer. Script calls are queued with EVALSHA directly,
+        # registered redis-py scripts would check that the script exists in a
+        # separate round trip before every pipeline.
+        self._transfer_script_sha = None
+        self._pipe = None
 
     def register(self, metric: Metric) -> None:
         """
@@ -38,15 +103,38 @@ class CollectorRegistry:
 
     def update_buffer(self, to_update: List[UpdateAction]) -> None:
         """
-        Updates registry buffer with updates from metrics. If registry is eager it will
-        also transfer buffer to remote Redis.
+        Updates registry buffer with updates from metrics. If registry is eager, or the
+        buffer has reached max_buffer_size, it will also transfer buffer to remote
+        Redis.
         :param to_update:
         :return:
         """
         for item in to_update:
             self.buffer[item.key] = item
 
-        if self.eager:
+        self._transfer_if_needed()
+
+    def update_buffer_one(self, item: UpdateAction) -> None:
+        """
+        Same as update_buffer but for a single update, which is what metrics produce
+        on every change.
+        :param item:
+        :return:
+        """
+        self.buffer[item.key] = item
+
+        self._transfer_if_needed()
+
+    def _transfer_if_needed(self) -> None:
+        """
+        Transfers the buffer if the registry is eager or the buffer has reached
+        max_buffer_size.
+        :return:
+        """
+        if self.eager or (
+            self.max_buffer_size is not None
+            and len(self.buffer) >= self.max_buffer_size
+        ):
             self.transfer()
 
     def transfer(self):
@@ -54,44 +142,96 @@ class CollectorRegistry:
         Transfer buffer to remote redis. When items are transferred a reset
         will be called on the metric to reset all counters.
 
+        All updates for a metric are applied by a single call to a Lua script that
+        also registers the metric type and description the first time the metric is
+        seen in Redis.
         """
-        metric_names = set()
-        incr_actions = list()
-        set_actions = list()
+        commands = dict()
 
         for action in self.buffer.values():
-            metric_names.add(action.key.split(":")[0])
             if action.set:
-                set_actions.append(action)
+                command = "s"
+            # Values are plain ints or floats so an exact type check is enough.
+            elif type(action.value) is int:
+                command = "i"
             else:
-                incr_actions.append(action)
-
-        hmset_map = {action.key: action.value for action in set_actions}
-
-        with self.pipe() as pipe:
-            if hmset_map:
-                pipe.hmset(self.namespace, hmset_map)
-            for action in incr_actions:
-                if isinstance(action.value, int):
-                    pipe.hincrby(self.namespace, action.key, action.value)
-                if isinstance(action.value, float):
-                    pipe.hincrbyfloat(self.namespace, action.key, action.value)
-
-        for metric_name in metric_names:
+                command = "f"
+            metric_name = action.key.partition(":")[0]
+            commands.setdefault(metric_name, list()).extend(
+                (command, action.key, action.value)
+            )
+
+        if commands:
+            try:
+                self._send_commands(commands)
+            except NoScriptError:
+                # The script cache was flushed, for example by a Redis restart. Every
+                # script call in the transaction failed, so none of them were applied.
+                self._transfer_script_sha = None
+                self._send_commands(commands)
+
+        for metric_name in commands:
             metric = self.metrics[metric_name]
             metric.reset()
 
-        self.buffer = dict()
+        self.buffer.clear()
 
-    @contextmanager
-    def pipe(self):
+    def _send_commands(self, commands: dict) -> None:
+        """
+        Sends one transfer script call per metric to Redis in a single pipeline.
+        :param commands: Script commands per metric name
+        :return:
         """
-        Context manager that will give a pipeline object if registry is not eager.
-        Otherwise normal redis object.
-                """
+        if self._transfer_script_sha is None:
+            self._transfer_script_sha = self.redis.script_load(TRANSFER_SCRIPT)
 
-        pipe = self.redis.pipeline()
+        index_key = make_index_key(self.namespace)
 
-        yield pipe
+        with self.pipe() as pipe:
+            for metric_name, metric_commands in commands.items():
+                metric = self.metrics[metric_name]
+                pipe.evalsha(
+                    self._transfer_script_sha,
+                    2,
+                    make_metric_key(self.namespace, metric_name),
+                    index_key,
+                    metric_name,
+                    metric.metric_type_key,
+                    metric.TYPE_KEY,
+                    metric.metric_description_key,
+                    metric.description,
+                    *metric_commands,
+                )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        """
+        Leaving the registry context transfers everything that was buffered within it
+        to Redis in one batch. If the block raised, nothing is transferred so a Redis
+        error can not hide the original exception. The updates stay in the buffer
+        and are sent with the next transfer.
+        """
+        if exc_type is None:
+            self.transfer()
 
-        pipe.execute()
+    @contextmanager
+    def pipe(self):
+        """
+        Context manager that will give a pipeline object. All commands are sent in a
+        single round trip when the context exits. The pipeline is wrapped in a
+        transaction so a connection lost while sending a transfer does not leave it
+        partly applied. A failed transfer keeps the buffer, and applying part of it
+        would count those updates twice when the buffer is transferred again.
+        The same pipeline is reused for every transfer and is reset afterwards, also
+        when the commands fail, so no commands are left for the next transfer.
+        """
+        if self._pipe is None:
+            self._pipe = self.redis.pipeline(transaction=True)
+
+        try:
+            yield self._pipe
+            self._pipe.execute()
+        finally:
+            self._pipe.reset()
@@ -1,11 +1,19 @@
-from redislite import StrictRedis
+import fakeredis
+import redislite
 import instrumentor
 import pytest
 
 
 @pytest.fixture()
-def redis():
-    return StrictRedis(db=0)
+def redis(request):
+    """
+    Tests run against an in-process fake Redis. Tests marked with
+    pytest.mark.integration run against a real Redis server started by redislite.
+    """
+    if request.node.get_closest_marker("integration"):
+        return redislite.StrictRedis(db=0)
+
+    return fakeredis.FakeStrictRedis(server=fakeredis.FakeServer())
 
 
 @pytest.fixture()
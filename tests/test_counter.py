@@ -46,6 +46,9 @@ class TestCounter:
     def test_counter_type_value(self, counter: instrumentor.Counter):
         assert counter.TYPE_KEY == "c"
 
+    def test_counter_has_no_instance_dict(self, counter: instrumentor.Counter):
+        assert not hasattr(counter, "__dict__")
+
     def test_reset(self, counter: instrumentor.Counter):
         counter.inc()
         counter.inc(3, labels={"code": "200", "path": "/api"})
@@ -80,6 +83,15 @@ class TestCounter:
 
         assert counter.counts['code="200"'] == 3
 
+    def test_count_decorator_with_not_allowed_labels_raises_value_error(
+        self, counter: instrumentor.Counter
+    ):
+        with pytest.raises(ValueError):
+
+            @counter.count(labels={"method": "GET"})
+            def try_count():
+                print("Counting")
+
     def test_using_reserved_labels_raises_value_error(
         self, counter: instrumentor.Counter
     ):
@@ -87,12 +99,64 @@ class TestCounter:
         with pytest.raises(ValueError):
             counter.inc(3, labels={"le": "200"})
 
+    def test_encoded_labels_are_cached(self, counter: instrumentor.Counter):
+        counter.inc(labels={"code": "200", "path": "/api"})
+        counter.inc(labels={"path": "/api", "code": "200"})
+
+        assert counter._label_cache == {
+            frozenset({("code", "200"), ("path", "/api")}): 'code="200",path="/api"'
+        }
+
+    def test_equal_label_values_are_encoded_separately(
+        self, registry: instrumentor.CollectorRegistry, counter: instrumentor.Counter
+    ):
+        other = instrumentor.Counter(
+            name="other_total", description="Test", allowed_labels=["code"]
+        )
+        registry.register(other)
+
+        other.inc(labels={"code": 1.0})
+        counter.inc(labels={"code": 1})
+        counter.inc(labels={"code": True})
+
+        assert other.counts['code="1.0"'] == 1
+        assert counter.counts['code="1"'] == 1
+        assert counter.counts['code="True"'] == 1
+
+    def test_unhashable_label_values(self, counter: instrumentor.Counter):
+        counter.inc(labels={"code": ["200"]})
+
+        assert counter.counts["code=\"['200']\""] == 1
+
+    def test_label_cache_is_bounded(self, counter: instrumentor.Counter, monkeypatch):
+        monkeypatch.setattr(instrumentor.metrics, "MAX_CACHED_LABEL_COMBINATIONS", 2)
+
+        for i in range(5):
+            counter.inc(labels={"path": f"/{i}"})
+
+        assert len(counter._label_cache) == 2
+        assert len(counter._redis_key_cache) == 2
+        assert counter.counts['path="/4"'] == 1
+
+    def test_not_allowed_labels_are_not_cached(self, counter: instrumentor.Counter):
+        with pytest.raises(ValueError):
+            counter.inc(labels={"method": "GET"})
+
+        with pytest.raises(ValueError):
+            counter.inc(labels={"method": "GET"})
+
+        assert counter._label_cache == {}
+
     def test_creating_counter_with_reserved_label_raises_value_error(self):
         with pytest.raises(ValueError):
             counter = instrumentor.Counter(
                 name="test", description="test", allowed_labels=["le"]
             )
 
+    def test_creating_counter_with_index_name_raises_value_error(self):
+        with pytest.raises(ValueError):
+            instrumentor.Counter(name="__index__", description="test")
+
 
 class TestCountDecorator:
     def test_with_counter(self, counter: instrumentor.Counter):
@@ -106,6 +170,15 @@ class TestCountDecorator:
 
         assert counter.counts["__"] == 3
 
+    def test_with_function_taking_arguments(self, counter: instrumentor.Counter):
+        @instrumentor.count(metric=counter)
+        def add(a, b=1):
+            return a + b
+
+        assert add(1) == 2
+        assert add(1, b=2) == 3
+        assert counter.counts["__"] == 2
+
     def test_with_counter_and_labels(self, counter: instrumentor.Counter):
         @instrumentor.count(metric=counter, labels={"code": "200"})
         def try_count():
@@ -0,0 +1,116 @@
+import pytest
+from redis import StrictRedis
+from instrumentor import CollectorRegistry, Counter, Histogram
+from instrumentor.exposition import ExpositionClient
+
+
+class TestExpositionClient:
+    def test_expose_counter(self, registry: CollectorRegistry, redis: StrictRedis):
+        counter = Counter(
+            name="http_requests_total",
+            description="Total HTTP Requests",
+            allowed_labels=["code"],
+        )
+        registry.register(counter)
+        counter.inc()
+        counter.inc(2, labels={"code": "200"})
+        registry.transfer()
+
+        client = ExpositionClient(redis_client=redis, namespace="testing")
+
+        assert client.expose() == (
+            "# HELP http_requests_total Total HTTP Requests\n"
+            "# TYPE http_requests_total counter\n"
+            "http_requests_total 1\n"
+            'http_requests_total{code="200"} 2\n'
+            "\n"
+        )
+
+    # Float sums are formatted by Redis, the fake formats them differently.
+    @pytest.mark.integration
+    def test_expose_histogram(self, registry: CollectorRegistry, redis: StrictRedis):
+        histogram = Histogram(
+            name="http_response_time_seconds",
+            description="HTTP Response Time in seconds.",
+            buckets=[0.1, 0.2, 2, 10],
+        )
+        registry.register(histogram)
+        histogram.observe(0.15)
+        registry.transfer()
+
+        client = ExpositionClient(redis_client=redis, namespace="testing")
+
+        assert client.expose() == (
+            "# HELP http_response_time_seconds HTTP Response Time in seconds.\n"
+            "# TYPE http_response_time_seconds histogram\n"
+            'http_response_time_seconds_bucket{le="0.2"} 1\n'
+            'http_response_time_seconds_bucket{le="2"} 1\n'
+            'http_response_time_seconds_bucket{le="10"} 1\n'
+            'http_response_time_seconds_bucket{le="+Inf"} 1\n'
+            "http_response_time_seconds_count 1\n"
+            "http_response_time_seconds_sum 0.15\n"
+            "\n"
+        )
+
+    def test_expose_histogram_buckets_in_order_per_labels(
+        self, registry: CollectorRegistry, redis: StrictRedis
+    ):
+        histogram = Histogram(
+            name="http_response_time_seconds",
+            description="HTTP Response Time in seconds.",
+            buckets=[0.5, 10, 2],
+            allowed_labels=["code", "path"],
+        )
+        registry.register(histogram)
+        histogram.observe(1, labels={"code": "200", "path": "/"})
+        histogram.observe(1, labels={"code": "500", "path": "/"})
+        registry.transfer()
+
+        client = ExpositionClient(redis_client=redis, namespace="testing")
+        buckets = [
+            line
+            for line in client.expose().splitlines()
+            if line.startswith("http_response_time_seconds_bucket")
+        ]
+
+        assert buckets == [
+            'http_response_time_seconds_bucket{code="200",le="2",path="/"} 1',
+            'http_response_time_seconds_bucket{code="200",le="10",path="/"} 1',
+            'http_response_time_seconds_bucket{code="200",le="+Inf",path="/"} 1',
+            'http_response_time_seconds_bucket{code="500",le="2",path="/"} 1',
+            'http_response_time_seconds_bucket{code="500",le="10",path="/"} 1',
+            'http_response_time_seconds_bucket{code="500",le="+Inf",path="/"} 1',
+        ]
+
+    def test_expose_only_metrics_in_namespace(
+        self, registry: CollectorRegistry, redis: StrictRedis
+    ):
+        counter = Counter(name="http_requests_total", description="Total HTTP Requests")
+        registry.register(counter)
+        counter.inc()
+        registry.transfer()
+
+        client = ExpositionClient(redis_client=redis, namespace="other")
+
+        assert client.expose() == ""
+
+    def test_expose_metric_larger_than_scan_count(
+        self, registry: CollectorRegistry, redis: StrictRedis
+    ):
+        counter = Counter(
+            name="http_requests_total",
+            description="Total HTTP Requests",
+            allowed_labels=["path"],
+        )
+        registry.register(counter)
+        for i in range(300):
+            counter.inc(labels={"path": f"/{i}"})
+        registry.transfer()
+
+        client = ExpositionClient(
+            redis_client=redis, namespace="testing", scan_count=10
+        )
+        lines = client.expose().splitlines()
+
+        assert len(lines) == 300 + 3
+        assert 'http_requests_total{path="/299"} 1' in lines
@@ -34,7 +34,7 @@ class TestHistogram:
         assert histogram.counts['code="200",le="0.4"'] == 1
         assert histogram.counts['code="200",le="0.8"'] == 1
         assert histogram.counts['code="200",le="1.6"'] == 1
-        assert histogram.counts['le="+Inf"'] == 1
+        assert histogram.counts['code="200",le="+Inf"'] == 1
         assert histogram.total_count == 1
 
     def test_observe_2(self, histogram: instrumentor.Histogram):
@@ -45,9 +45,40 @@ class TestHistogram:
         assert histogram.counts['code="200",le="0.4"'] == 1
         assert histogram.counts['code="200",le="0.8"'] == 2
         assert histogram.counts['code="200",le="1.6"'] == 2
-        assert histogram.counts['le="+Inf"'] == 2
+        assert histogram.counts['code="200",le="+Inf"'] == 2
         assert histogram.total_count == 2
 
+    def test_sum_and_count_per_label_combination(
+        self, histogram: instrumentor.Histogram, redis
+    ):
+        histogram.observe(0.5, labels={"code": "200"})
+        histogram.observe(0.25, labels={"code": "200"})
+        histogram.observe(2, labels={"code": "500"})
+        histogram.registry.transfer()
+
+        values = redis.hgetall("testing:http_response_time_seconds")
+        assert values[b'http_response_time_seconds:c:code="200"'] == b"2"
+        assert values[b'http_response_time_seconds:s:code="200"'] == b"0.75"
+        assert values[b'http_response_time_seconds:b:code="200",le="+Inf"'] == b"2"
+        assert values[b'http_response_time_seconds:c:code="500"'] == b"1"
+        assert values[b'http_response_time_seconds:s:code="500"'] == b"2"
+
+    def test_observe_unsorted_buckets(self, registry: instrumentor.CollectorRegistry):
+        histogram = instrumentor.Histogram(
+            name="unsorted_seconds", description="Test", buckets=[1.6, 0.1, 0.4]
+        )
+        registry.register(histogram)
+        histogram.observe(0.4)
+
+        assert histogram.counts == {'le="0.4"': 1, 'le="1.6"': 1, 'le="+Inf"': 1}
+
+    def test_observe_nan_only_counts_infinity_bucket(
+        self, histogram: instrumentor.Histogram
+    ):
+        histogram.observe(float("nan"))
+
+        assert histogram.counts == {'le="+Inf"': 1}
+
     def test_time_decorator(self, histogram: instrumentor.Histogram):
         @histogram.time
         def time_it():
@@ -67,6 +98,15 @@ class TestHistogram:
         assert histogram.sum > 0
         assert histogram.counts['code="200",le="1.6"'] == 1
 
+    def test_time_decorator_with_not_allowed_label_raises_value_error(
+        self, histogram: instrumentor.Histogram
+    ):
+        with pytest.raises(ValueError):
+
+            @histogram.time(labels={"method": "GET"})
+            def time_it():
+                pass
+
     def test_reset(self, histogram: instrumentor.Histogram):
         histogram.reset()
 
@@ -104,3 +144,25 @@ class TestTimerDecorator:
 
         assert histogram.sum > 0
         assert histogram.counts['le="+Inf"'] == 1
+
+    def test_with_histogram_observes_when_function_raises(
+        self, histogram: instrumentor.Histogram
+    ):
+        @instrumentor.timer(metric=histogram)
+        def time_it():
+            raise ValueError()
+
+        with pytest.raises(ValueError):
+            time_it()
+
+        assert histogram.counts['le="+Inf"'] == 1
+
+    def test_with_histogram_recursive(self, histogram: instrumentor.Histogram):
+        @instrumentor.timer(metric=histogram)
+        def time_it(depth):
+            if depth:
+                time_it(depth - 1)
+
+        time_it(2)
+
+        assert histogram.counts['le="+Inf"'] == 3
@@ -1,5 +1,7 @@
+import fakeredis
 import pytest
-from redislite import StrictRedis
+from redis import StrictRedis
+from redis.exceptions import ConnectionError
 from instrumentor import CollectorRegistry
 from instrumentor import Counter, Gauge
 from instrumentor.metrics import UpdateAction
@@ -57,11 +59,11 @@ class TestCollectorRegistry:
 
         counter.inc()
 
-        assert redis.hgetall("testing") == {}
+        assert redis.hgetall("testing:http_requests_total") == {}
 
         registry.transfer()
 
-        assert redis.hgetall("testing") != {}
+        assert redis.hgetall("testing:http_requests_total") != {}
 
     def test_eager(self, registry: CollectorRegistry, redis: StrictRedis):
         counter = Counter(name="http_requests_total", description="Total HTTP Requests")
@@ -72,7 +74,177 @@ class TestCollectorRegistry:
 
         counter.inc()
 
-        assert redis.hgetall("testing") != {}
+        assert redis.hgetall("testing:http_requests_total") != {}
+
+    def test_context_manager_transfers_on_exit(
+        self, registry: CollectorRegistry, redis: StrictRedis
+    ):
+        counter = Counter(name="http_requests_total", description="Total HTTP Requests")
+        registry.register(counter)
+
+        with registry:
+            counter.inc()
+            counter.inc()
+
+            assert redis.hgetall("testing:http_requests_total") == {}
+
+        assert (
+            redis.hget("testing:http_requests_total", "http_requests_total::") == b"2"
+        )
+        assert registry.buffer == {}
+
+    def test_context_manager_does_not_transfer_on_exception(
+        self, registry: CollectorRegistry, redis: StrictRedis
+    ):
+        counter = Counter(name="http_requests_total", description="Total HTTP Requests")
+        registry.register(counter)
+
+        with pytest.raises(ValueError):
+            with registry:
+                counter.inc()
+                raise ValueError()
+
+        assert redis.hgetall("testing:http_requests_total") == {}
+        assert registry.buffer != {}
+
+    def test_failed_transfer_keeps_buffer(self):
+        server = fakeredis.FakeServer()
+        redis = fakeredis.FakeStrictRedis(server=server)
+        registry = CollectorRegistry(redis_client=redis, namespace="testing")
+        counter = Counter(name="http_requests_total", description="Total HTTP Requests")
+        registry.register(counter)
+        counter.inc()
+        registry.transfer()
+
+        counter.inc()
+        server.connected = False
+        with pytest.raises(ConnectionError):
+            registry.transfer()
+        server.connected = True
+        registry.transfer()
+
+        assert (
+            redis.hget("testing:http_requests_total", "http_requests_total::") == b"2"
+        )
+
+    def test_transfer_adds_metric_to_index(
+        self, registry: CollectorRegistry, redis: StrictRedis
+    ):
+        counter = Counter(name="http_requests_total", description="Total HTTP Requests")
+        registry.register(counter)
+
+        counter.inc()
+        registry.transfer()
+
+        assert redis.smembers("testing:__index__") == {b"http_requests_total"}
+
+    def test_transfer_reindexes_metric_if_index_is_lost(
+        self, registry: CollectorRegistry, redis: StrictRedis
+    ):
+        counter = Counter(name="http_requests_total", description="Total HTTP Requests")
+        registry.register(counter)
+
+        counter.inc()
+        registry.transfer()
+        redis.delete("testing:__index__")
+        counter.inc()
+        registry.transfer()
+
+        assert redis.smembers("testing:__index__") == {b"http_requests_total"}
+
+    @pytest.mark.integration
+    def test_transfer_writes_type_and_description(
+        self, registry: CollectorRegistry, redis: StrictRedis
+    ):
+        counter = Counter(name="http_requests_total", description="Total HTTP Requests")
+        registry.register(counter)
+
+        counter.inc()
+        registry.transfer()
+        counter.inc()
+        registry.transfer()
+
+        assert redis.hgetall("testing:http_requests_total") == {
+            b"http_requests_total:t:": b"c",
+            b"http_requests_total:d:": b"Total HTTP Requests",
+            b"http_requests_total::": b"2",
+        }
+
+    def test_transfer_rewrites_deleted_description(
+        self, registry: CollectorRegistry, redis: StrictRedis
+    ):
+        counter = Counter(name="http_requests_total", description="Total HTTP Requests")
+        registry.register(counter)
+
+        counter.inc()
+        registry.transfer()
+        redis.hdel("testing:http_requests_total", "http_requests_total:d:")
+
+        new_registry = CollectorRegistry(redis_client=redis, namespace="testing")
+        new_counter = Counter(name="http_requests_total", description="New description")
+        new_registry.register(new_counter)
+        new_counter.inc()
+        new_registry.transfer()
+
+        assert redis.hgetall("testing:http_requests_total") == {
+            b"http_requests_total:t:": b"c",
+            b"http_requests_total:d:": b"New description",
+            b"http_requests_total::": b"2",
+        }
+
+    # fakeredis 1.0 does not implement SCRIPT FLUSH.
+    @pytest.mark.integration
+    def test_transfer_reloads_flushed_script(
+        self, registry: CollectorRegistry, redis: StrictRedis
+    ):
+        counter = Counter(name="http_requests_total", description="Total HTTP Requests")
+        registry.register(counter)
+
+        counter.inc()
+        registry.transfer()
+        redis.script_flush()
+        counter.inc()
+        registry.transfer()
+
+        assert (
+            redis.hget("testing:http_requests_total", "http_requests_total::") == b"2"
+        )
+        assert registry.buffer == {}
+
+    def test_transfer_when_buffer_is_full(
+        self, registry: CollectorRegistry, redis: StrictRedis
+    ):
+        counter = Counter(
+            name="http_requests_total",
+            description="Total HTTP Requests",
+            allowed_labels=["code"],
+        )
+        registry.register(counter)
+        registry.max_buffer_size = 2
+
+        counter.inc(labels={"code": "200"})
+        counter.inc(labels={"code": "200"})
+
+        assert redis.hgetall("testing:http_requests_total") == {}
+
+        counter.inc(labels={"code": "500"})
+
+        assert redis.hgetall("testing:http_requests_total") != {}
+        assert registry.buffer == {}
+
+    def test_pipe_is_reset_when_commands_fail(
+        self, registry: CollectorRegistry, redis: StrictRedis
+    ):
+        with pytest.raises(ValueError):
+            with registry.pipe() as pipe:
+                pipe.set("testing:left_over", 1)
+                raise ValueError()
+
+        with registry.pipe() as pipe:
+            pipe.set("testing:next", 1)
+
+        assert redis.get("testing:left_over") is None
+        assert redis.get("testing:next") == b"1"
 
     def test_update_buffer(self, registry: CollectorRegistry):
         test_key = "test"
@@ -83,3 +255,10 @@ class TestCollectorRegistry:
         registry.update_buffer(to_update)
 
         assert registry.buffer[test_key] == test_action
+
+    def test_update_buffer_one(self, registry: CollectorRegistry):
+        test_action = UpdateAction(key="test", value=1)
+
+        registry.update_buffer_one(test_action)
+
+        assert registry.buffer == {"test": test_action}